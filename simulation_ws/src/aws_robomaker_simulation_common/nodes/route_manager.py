@@ -14,14 +14,16 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-import itertools
+from collections import deque
 from math import cos, sin
 import random
+import threading
 
 import actionlib
-from geometry_msgs.msg import Point, Quaternion
+from geometry_msgs.msg import Point, Pose, Quaternion
 from move_base_msgs.msg import MoveBaseAction, MoveBaseGoal
 from nav_msgs.msg import MapMetaData, OccupancyGrid, Path
+import numpy as np
 import rospy
 import tf.transformations as transform
 
@@ -37,15 +39,36 @@ class GoalGenerator():
 
         Assumes that the map is held static after node
         initialisation and is not updated while the node is running.
+        Otherwise call index_map after refreshing the map data, the
+        generator used in dynamic mode is RouteManager.goal_generator.
     """
 
+    # Number of goals generated at once when the goal pool runs empty
+    pool_size = 1024
+
+    # Orientation of every generated goal, quaternion_from_euler(0, 0, 0).
+    # Shared between goals, which are only read once created.
+    _identity_quat = Quaternion(x=0., y=0., z=0., w=1.)
+
     def __init__(self):
         # Assuming map is static after node init and not updated while the node
-        # is running. If not, this must be refreshed at regular intervals or on
-        # some callbacks.
+        # is running. If not, meta_data and occupancy_data must be refreshed at
+        # regular intervals or on some callbacks, followed by a call to
+        # index_map.
         self.meta_data = rospy.wait_for_message('map_metadata', MapMetaData)
         self.occupancy_data = rospy.wait_for_message('map', OccupancyGrid)
 
+        self.index_map()
+
+    def index_map(self):
+        """
+        Build everything used to generate goals from the current map.
+
+        Reads meta_data and occupancy_data, so a map refresh only needs to
+        update both and call this again. Goals queued from the previous map
+        are dropped.
+
+        """
         # map.yaml only specifies x,y and yaw transforms of the origin wrt
         # world frame
         self.map_orientation = transform.euler_from_quaternion(
@@ -58,114 +81,90 @@ class GoalGenerator():
         self.map_origin_x0 = self.meta_data.origin.position.x
         self.map_origin_y0 = self.meta_data.origin.position.y
         self.resolution = self.meta_data.resolution
-
-    def ravel_index(self, x, y):
-        """
-        Ravel 2d grid coordinates in row-major order.
-
-        Args
-        ----
-            x(int): in grid coordinates
-            y(int): in grid coordinates
-
-        Returns
-        -------
-            int
-
-        """
-        return y * (self.meta_data.width) + x
-
-    def grid_to_world_2d(self, x, y):
+        # Constant terms of the grid to world transform
+        self._cos_yaw = cos(self.map_yaw)
+        self._sin_yaw = sin(self.map_yaw)
+        if abs(self.map_yaw) < 1e-9:
+            # Most maps are not rotated wrt the world frame
+            self.grid_to_world_2d = self._grid_to_world_2d_unrotated
+        else:
+            self.grid_to_world_2d = self._grid_to_world_2d_rotated
+
+        # Grid dimensions, read often enough to be worth binding directly
+        self._w = self.meta_data.width
+        self._h = self.meta_data.height
+
+        # Row-major (height, width) view of the occupancy values so that
+        # neighborhood checks can be done with array slicing.
+        self._grid = np.asarray(
+            self.occupancy_data.data, dtype=np.int8).reshape(self._h, self._w)
+        # Size of the neighborhood inspected by check_noise, to make it
+        # depend on resolution
+        delta_x = max(2, self._w // 50)
+        delta_y = max(2, self._h // 50)
+        # Summed-area table of occupied cells, zero padded on the top and
+        # left so that any window sum is four lookups without edge cases.
+        # It is only needed here, large maps should not keep it around.
+        # Both passes accumulate as int32 straight into the table rather
+        # than into default int64 intermediates.
+        sat = np.zeros((self._h + 1, self._w + 1), dtype=np.int32)
+        np.cumsum(self._grid != 0, axis=0, dtype=np.int32, out=sat[1:, 1:])
+        np.cumsum(sat[1:, 1:], axis=1, out=sat[1:, 1:])
+
+        # Valid goals only depend on the map. Evaluate the check_noise window
+        # of every cell at once. Each gathered term is a map sized copy, the
+        # sum accumulates into the first one so at most two exist at a time.
+        cols = np.arange(self._w)
+        rows = np.arange(self._h)
+        l_bound = np.maximum(0, cols - delta_x)
+        r_bound = np.minimum(self._w, cols + delta_x + 1)
+        t_bound = np.maximum(0, rows - delta_y)
+        b_bound = np.minimum(self._h, rows + delta_y + 1)
+        window_sums = sat[np.ix_(b_bound, r_bound)]
+        window_sums -= sat[np.ix_(t_bound, r_bound)]
+        window_sums -= sat[np.ix_(b_bound, l_bound)]
+        window_sums += sat[np.ix_(t_bound, l_bound)]
+        # One byte per cell answers check_noise, the flat indices of the
+        # valid cells are what goals are sampled from.
+        self._safe = window_sums == 0
+        self._safe_idx = np.flatnonzero(self._safe).astype(np.int32)
+
+        # Goals in world coordinates, generated in batches by _refill_pool
+        self._pool = deque()
+
+    def _grid_to_world_2d_rotated(self, x, y):
         """
         Transform x-y planar grid coordinates to world coordinates.
 
         The function adheres to the assumption that
             grid-world transform is only x-y translation and yaw rotation.
+        index_map binds it as grid_to_world_2d unless the map yaw is zero.
 
         Args
         ----
-            x(int): in grid coordinates
-            x(int): in grid coordinates
+            x(int or numpy.ndarray): in grid coordinates
+            y(int or numpy.ndarray): in grid coordinates
 
         Returns
         -------
-            List(int): in world coordinates
+            List(float or numpy.ndarray): in world coordinates
 
         """
+        x_grid = self.resolution * x
+        y_grid = self.resolution * y
         x_world = self.map_origin_x0 + \
-            (cos(self.map_yaw) * (self.resolution * x)
-                - sin(self.map_yaw) * (self.resolution * y))
+            (self._cos_yaw * x_grid - self._sin_yaw * y_grid)
         y_world = self.map_origin_y0 + \
-            (sin(self.map_yaw) * (self.resolution * x) +
-                cos(self.map_yaw) * (self.resolution * y))
+            (self._sin_yaw * x_grid + self._cos_yaw * y_grid)
 
         return [x_world, y_world]
 
-    def _create_pos(
-            self,
-            x_world,
-            y_world,
-            z_world,
-            euler_orientation_x,
-            euler_orientation_y,
-            euler_orientation_z):
-        """
-        Wrap 3D euler location and orientation input to a Pose.
+    def _grid_to_world_2d_unrotated(self, x, y):
+        """_grid_to_world_2d_rotated for maps with zero yaw."""
+        return [self.map_origin_x0 + self.resolution * x,
+                self.map_origin_y0 + self.resolution * y]
 
-        Args
-        ----
-            x(float): in world coordinates
-            y(float): in world coordinates
-            z(float): in world coordinates
-            orientation_x(float): in world coordinates,
-            orientation_y(float): in world coordinates
-            orientation_z(float): in world coordinates
-
-        Returns
-        -------
-            Pose:
-                {
-                    'position': {
-                        'x': double
-                        'y': double
-                        'z': double
-                    }
-                    'orientation': {
-                        'x': double
-                        'y': double
-                        'z': double
-                        'w': double
-                    }
-                }
-
-        """
-        position = {
-            'x': x_world,
-            'y': y_world,
-            'z': z_world
-        }
-
-        # Make sure the quaternion is valid and normalized
-        quaternion_orientation = transform.quaternion_from_euler(
-            euler_orientation_x, euler_orientation_y, euler_orientation_z)
-        orientation = {
-            'x': quaternion_orientation[0],
-            'y': quaternion_orientation[1],
-            'z': quaternion_orientation[2],
-            'w': quaternion_orientation[3]
-        }
-
-        p = {
-            'pose':
-            {
-                'position': position,
-                'orientation': orientation
-            }
-        }
-
-        return p
-
-    def check_noise(self, x, y, row_id=None):
+    def check_noise(self, x, y):
         """
         Check if the point in the world is not a map consistency.
 
@@ -184,28 +183,24 @@ class GoalGenerator():
             bool. False if noise, else True
 
         """
-        # to make it depend on resolution
-        delta_x = max(2, self.meta_data.width // 50)
-        delta_y = max(2, self.meta_data.height // 50)
-
-        l_bound, r_bound = max(
-            0, x - delta_x), min(self.meta_data.width - 1, x + delta_x)
-        t_bound, b_bound = max(
-            0, y - delta_y), min(self.meta_data.height - 1, y + delta_y)
-
-        for _x in range(l_bound, r_bound):
-            for _y in range(t_bound, b_bound):
-                _row_id = self.ravel_index(_x, _y)
-                if self.occupancy_data.data[_row_id] != 0:
-                    return False
-
-        return True
+        # Window covers [x - delta_x, x + delta_x] and
+        # [y - delta_y, y + delta_y], clipped to the map. It is evaluated for
+        # every cell in index_map.
+        return bool(self._safe[y, x])
+
+    def _refill_pool(self):
+        """Draw a batch of valid goals and queue their world coordinates."""
+        row_ids = self._safe_idx[
+            np.random.randint(0, self._safe_idx.size, self.pool_size)]
+        y_grid, x_grid = np.divmod(row_ids, self._w)
+        x_world, y_world = self.grid_to_world_2d(x_grid, y_grid)
+        self._pool.extend(zip(x_world.tolist(), y_world.tolist()))
 
     def get_next(self):
         """
         Get next goal.
 
-        Scan the map for a valid goal.
+        Pick a random goal among the valid cells precomputed at init.
         Convert to world coordinates and wraps as a Pose
          to be consumed by route manager.
 
@@ -214,42 +209,25 @@ class GoalGenerator():
 
         Returns
         -------
-            Pose:
-                {
-                    'position': {
-                        'x': double
-                        'y': double
-                        'z': double
-                    }
-                    'orientation': {
-                        'x': double
-                        'y': double
-                        'z': double
-                        'w': double
-                    }
-                }
+            geometry_msgs.msg.Pose
 
         """
         z_world_floor = 0.
-        euler_orientation = [0., 0., 0.]
-
-        rospy.loginfo('Searching for a valid goal')
-        timeout_iter = 100
-        iteration = 0
-        while iteration < timeout_iter:
-            _x = random.randint(0, self.meta_data.width - 1)
-            _y = random.randint(0, self.meta_data.height - 1)
-            _row_id = self.ravel_index(_x, _y)
-            if self.occupancy_data.data[_row_id] == 0 and self.check_noise(
-                    _x, _y, row_id=_row_id):
-                x_world, y_world = self.grid_to_world_2d(_x, _y)
-                rospy.loginfo('Valid goal found!')
-                return self._create_pos(
-                    x_world, y_world, z_world_floor, *euler_orientation)
-
-        rospy.logerr('Could not find a valid goal in the world. Check that \
-            your occupancy map has Trinary value representation and is not \
-            visually noisy/incorrect')
+
+        rospy.logdebug('Searching for a valid goal')
+        if self._safe_idx.size:
+            if not self._pool:
+                self._refill_pool()
+            x_world, y_world = self._pool.popleft()
+            rospy.logdebug('Valid goal found!')
+            return Pose(
+                position=Point(x=x_world, y=y_world, z=z_world_floor),
+                orientation=self._identity_quat)
+
+        rospy.logerr(
+            'Could not find a valid goal in the world. Check that your '
+            'occupancy map has Trinary value representation and is not '
+            'visually noisy/incorrect')
         return None
 
 
@@ -262,11 +240,7 @@ class RouteManager():
     Echo the input goal on topic /move_base_simple/goal
     """
 
-    route_modes = {
-        'inorder': lambda goals: itertools.cycle(goals),
-        'random': lambda goals: (
-            random.choice(goals) for i in itertools.count()),
-        'dynamic': lambda goals: GoalGenerator()}
+    route_modes = ('inorder', 'random', 'dynamic')
 
     def __init__(self):
         self.route = []
@@ -274,6 +248,15 @@ class RouteManager():
         self.client = actionlib.SimpleActionClient('move_base', MoveBaseAction)
         self.client.wait_for_server()
 
+        # Keep a single subscription to the global plan for the lifetime of
+        # the node, each goal then waits for the next plan to be received.
+        self._plan_received = threading.Event()
+        self._plan_sub = rospy.Subscriber(
+            '/move_base/DWAPlannerROS/global_plan',
+            Path,
+            self._plan_callback,
+            queue_size=1)
+
         self.route_mode = rospy.get_param('~mode')
         if self.route_mode not in RouteManager.route_modes:
             rospy.logerr(
@@ -281,26 +264,58 @@ class RouteManager():
                 self.route_mode)
             return
 
-        poses = rospy.get_param('~poses', [])
+        # Convert the route to messages once rather than for every goal
+        poses = tuple(
+            Pose(
+                position=Point(**pose['pose']['position']),
+                orientation=Quaternion(**pose['pose']['orientation']))
+            for pose in rospy.get_param('~poses', []))
         if not poses and self.route_mode != 'dynamic':
             rospy.loginfo(
                 'Route manager initialized no goals, unable to route')
 
-        self.goals = RouteManager.route_modes[self.route_mode](poses)
+        self.goals = poses
+        self._goal_index = 0
+        # Only set in dynamic mode, kept so its map can be refreshed
+        self.goal_generator = None
+        if self.route_mode == 'dynamic':
+            self.goal_generator = GoalGenerator()
+            self._next_goal = self.goal_generator.get_next
+        elif self.route_mode == 'random':
+            self._next_goal = self._next_random
+        else:
+            self._next_goal = self._next_inorder
         rospy.loginfo('Route manager initialized in %s mode', self.route_mode)
 
         self.bad_goal_counter = 0
 
-    def to_move_goal(self, pose):
+    def _next_inorder(self):
+        if not self.goals:
+            raise ValueError('Route has no goals')
+
+        pose = self.goals[self._goal_index]
+        self._goal_index = (self._goal_index + 1) % len(self.goals)
+        return pose
+
+    def _next_random(self):
+        if not self.goals:
+            raise ValueError('Route has no goals')
+
+        return random.choice(self.goals)
+
+    def _plan_callback(self, plan):
+        self._plan_received.set()
+
+    def to_move_goal(self, pose, stamp=None):
         if pose is None:
             raise ValueError('Goal position cannot be NULL')
 
         goal = MoveBaseGoal()
-        goal.target_pose.header.stamp = rospy.Time.now()
+        # Goals built together can share a stamp taken by the caller
+        goal.target_pose.header.stamp = \
+            rospy.Time.now() if stamp is None else stamp
         goal.target_pose.header.frame_id = 'map'
-        goal.target_pose.pose.position = Point(**pose['pose']['position'])
-        goal.target_pose.pose.orientation = Quaternion(
-            **pose['pose']['orientation'])
+        goal.target_pose.pose = pose
         return goal
 
     def route_forever(self):
@@ -308,47 +323,39 @@ class RouteManager():
         while not rospy.is_shutdown():
             if self.bad_goal_counter > 10:
                 rospy.loginfo(
-                    'Stopping route manager due to too many bad goals.\
-                    Check that your occupancy map has Trinary value\
-                    representation and is not\
-                    visually noisy/incorrect'
-                    )
+                    'Stopping route manager due to too many bad goals. '
+                    'Check that your occupancy map has Trinary value '
+                    'representation and is not visually noisy/incorrect')
                 return
             else:
-                rospy.loginfo(
+                rospy.logdebug(
                     'Route mode is %s, getting next goal',
                     self.route_mode)
                 try:
-                    if self.route_mode == 'dynamic':
-                        # TODO: flake8 linting standard does not allow over-riding
-                        # the built-in python method next() which is required to
-                        # make 'self.goals' a iterator.
-                        current_goal = self.to_move_goal(self.goals.get_next())
-                    else:
-                        current_goal = self.to_move_goal(next(self.goals))
+                    current_goal = self.to_move_goal(self._next_goal())
                 except ValueError as e:
                     rospy.loginfo(
-                        'No valid goal was found in the map, stopping route manager\
-                            due to following exception,\n{0}'.format(str(e)))
+                        'No valid goal was found in the map, stopping route '
+                        'manager due to following exception,\n{0}'.format(
+                            str(e)))
                     return
 
-                rospy.loginfo('Sending target goal: %s', current_goal)
+                rospy.logdebug('Sending target goal: %s', current_goal)
+                self._plan_received.clear()
                 self.client.send_goal(current_goal)
 
                 try:
                     # wait 5sec for global plan to be published. If not, scan
                     # for a new goal..
-                    rospy.wait_for_message(
-                        '/move_base/DWAPlannerROS/global_plan',
-                        Path,
-                        timeout=5
-                        )
+                    if not self._plan_received.wait(5):
+                        raise rospy.exceptions.ROSException(
+                            'timeout exceeded while waiting for global plan')
 
                     if not self.client.wait_for_result():
                         rospy.logerr(
                             'Move server not ready, will try again...')
                     elif self.client.get_result():
-                        rospy.loginfo('Goal done: %s', current_goal)
+                        rospy.logdebug('Goal done: %s', current_goal)
 
                     rate.sleep()
 